@@ -1,25 +1,68 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
-from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+import bisect
+import functools
+import json
+import logging
+import os
+import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import date, datetime, timezone
 from pathlib import Path
+from typing import NamedTuple
 
 # ---------------------------------------------------------
 # INITIALIZATION
 # ---------------------------------------------------------
 
+logger = logging.getLogger(__name__)
+
 # Initialize session state storage for saving props
 if "last_analysis" not in st.session_state:
     st.session_state.last_analysis = None
 
-API_KEY = "7f4db7a9-c34e-478d-a799-fef77b9d1f78"
-BASE_URL = "https://api.balldontlie.io/v1"
-HEADERS = {"Authorization": API_KEY}
-
-# Writable in all Streamlit Cloud environments
-SAVED_PROPS = Path("saved_props.csv")
+def _api_key():
+    """balldontlie key from st.secrets, falling back to the environment."""
+    try:
+        key = st.secrets.get("BDL_API_KEY")
+    except FileNotFoundError:
+        # No secrets.toml at all
+        key = None
+    return key or os.environ.get("BDL_API_KEY", "")
 
-NBA_TEAMS = [
+API_KEY = _api_key()
+BASE_URL = "https://api.balldontlie.io/v1"
+# (connect, read) seconds; a dead host fails fast instead of eating the read budget
+API_TIMEOUT = (3.05, 10)
+# How long analyze waits for the defensive rating once the player's splits are ready
+DEF_RATING_WAIT = 2.0
+
+# Writable in all Streamlit Cloud environments.
+# Each save is its own small Parquet file; the directory reads back as one table.
+SAVED_PROPS = Path("saved_props")
+LEGACY_SAVED_CSV = Path("saved_props.csv")
+SAVED_TABLE_ROWS = 200
+SAVED_COMPACT_AT = 64
+# Dot-prefixed, so the reader skips them while a compaction is in flight
+COMPACT_PENDING = SAVED_PROPS / ".compact.parquet"
+COMPACT_MANIFEST = SAVED_PROPS / ".compact.json"
+SAVED_SCHEMA = pa.schema([
+    ("timestamp", pa.string()), ("player", pa.string()), ("player_id", pa.int64()),
+    ("team", pa.string()), ("stat", pa.string()), ("line", pa.float64()),
+    ("odds", pa.string()), ("projection", pa.float64()), ("opponent", pa.string()),
+    ("outcome", pa.string()),
+])
+
+NBA_TEAMS = (
     ("Atlanta Hawks", "ATL"), ("Boston Celtics", "BOS"), ("Brooklyn Nets", "BKN"),
     ("Charlotte Hornets", "CHA"), ("Chicago Bulls", "CHI"), ("Cleveland Cavaliers", "CLE"),
     ("Dallas Mavericks", "DAL"), ("Denver Nuggets", "DEN"), ("Detroit Pistons", "DET"),
@@ -31,289 +74,591 @@ NBA_TEAMS = [
     ("Portland Trail Blazers", "POR"), ("Sacramento Kings", "SAC"),
     ("San Antonio Spurs", "SAS"), ("Toronto Raptors", "TOR"),
     ("Utah Jazz", "UTA"), ("Washington Wizards", "WAS"),
-]
+)
+
+# Opponent selectbox labels, built once instead of on every rerun
+OPP_LABELS = tuple(f"{n} ({a})" for n, a in NBA_TEAMS)
+LABEL_TO_ABBR = {lbl: a for lbl, (_, a) in zip(OPP_LABELS, NBA_TEAMS)}
 
 STAT_MAP = {
     "Points": "pts", "Rebounds": "reb", "Assists": "ast",
     "Threes Made": "fg3m", "Steals": "stl", "Blocks": "blk",
     "Turnovers": "turnover", "Minutes": "min",
 }
+STAT_OPTIONS = tuple(STAT_MAP)
+STAT_FIELDS = tuple(STAT_MAP.values())
+# Box-score counts; "min" arrives as "MM:SS" and is parsed separately
+STAT_COLUMNS = tuple(f for f in STAT_FIELDS if f != "min")
 
 # ---------------------------------------------------------
 # CORRECT SEASON DETECTION
 # ---------------------------------------------------------
 
-def get_current_nba_season():
+def get_current_nba_season(today=None):
     """
-    Returns the NBA season year.
+    Returns the NBA season year for today (or the given date).
     Example:
     2025–26 season → returns 2025
     """
-    now = datetime.now()
-    year = now.year
-    month = now.month
-
+    d = today or date.today()
     # NBA season starts in October
-    if month >= 10:
-        return year
-    else:
-        return year - 1
+    return d.year - (d.month < 10)
+
+# ---------------------------------------------------------
+# STALE-WHILE-REVALIDATE CACHE
+# ---------------------------------------------------------
+
+@st.cache_resource
+def _swr_state():
+    # Lives in cache_resource because module globals are reset on every rerun
+    return {"lock": threading.Lock(), "values": {}, "refreshing": set()}
+
+
+def _swr_store(state, key, value, stale_for):
+    now = time.monotonic()
+    with state["lock"]:
+        values = state["values"]
+        values[key] = (now, value)
+        # Drop this function's entries too old to be served, so per-player
+        # keys don't accumulate for the life of the process
+        for k in [k for k, (t, _) in values.items() if k[0] == key[0] and now - t >= stale_for]:
+            del values[k]
+
+
+def _swr_refresh(state, key, fn, args, stale_for):
+    with state["lock"]:
+        if key in state["refreshing"]:
+            return
+        state["refreshing"].add(key)
+
+    def run():
+        try:
+            _swr_store(state, key, fn(*args), stale_for)
+        except Exception as e:
+            logger.warning("Background refresh of %s failed: %s", key[0], e)
+        finally:
+            with state["lock"]:
+                state["refreshing"].discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def stale_while_revalidate(fresh_for, stale_for):
+    """
+    Process-wide result cache for slow, slowly-changing lookups.
+    Younger than fresh_for seconds: returned as is. Younger than stale_for:
+    returned immediately while a background thread recomputes it. Older or
+    missing: computed inline. Exceptions are never cached.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            state = _swr_state()
+            key = (fn.__qualname__, args)
+            with state["lock"]:
+                hit = state["values"].get(key)
+            if hit is not None:
+                age = time.monotonic() - hit[0]
+                if age < fresh_for:
+                    return hit[1]
+                if age < stale_for:
+                    _swr_refresh(state, key, fn, args, stale_for)
+                    return hit[1]
+
+            value = fn(*args)
+            _swr_store(state, key, value, stale_for)
+            return value
+        return wrapper
+    return decorate
 
 # ---------------------------------------------------------
 # API METHODS
 # ---------------------------------------------------------
 
-def api_get(endpoint, params=None):
-    try:
-        r = requests.get(f"{BASE_URL}/{endpoint}", headers=HEADERS, params=params or {}, timeout=10)
-        r.raise_for_status()
-        return r.json()
-    except:
-        return {"data": []}
+class ApiError(Exception):
+    """A balldontlie request failed (network, HTTP status or bad JSON)."""
 
+@st.cache_resource
+def get_session():
+    """
+    One pooled keep-alive session shared by every API call and worker thread.
+    The API key is sent per request, so a rotated key applies on the next rerun.
+    """
+    session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+    ))
+    return session
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get(endpoint, params):
+    # Raises on failure so errors are never memoized; api_get handles them.
+    r = get_session().get(
+        f"{BASE_URL}/{endpoint}",
+        params=dict(params),
+        headers={"Authorization": API_KEY},
+        timeout=API_TIMEOUT,
+    )
+    r.raise_for_status()
+    return r.json()
 
-def get_players(query):
-    raw = api_get("players", {"search": query, "per_page": 50})
-    uniq = {}
-    for p in raw.get("data", []):
-        uniq.setdefault((p["first_name"], p["last_name"]), p)
-    return list(uniq.values())
 
+def api_get(endpoint, params=None):
+    """Cached GET; raises ApiError instead of passing a failure off as empty data."""
+    try:
+        return _cached_get(endpoint, tuple(sorted((params or {}).items())))
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("GET %s failed: %s", endpoint, e)
+        raise ApiError(f"GET /{endpoint} failed: {e}") from e
 
-def get_stats(player_id, season):
-    results = []
-    cursor = None
 
-    while True:
-        params = {"player_ids[]": player_id, "seasons[]": season, "per_page": 100}
-        if cursor:
-            params["cursor"] = cursor
+def api_get_all(endpoint, params):
+    """
+    Collects every page of a paginated endpoint by walking meta.next_cursor.
+    balldontlie v1 cursors are opaque and only arrive with the previous page,
+    so the walk is necessarily sequential.
+    """
+    first = api_get(endpoint, params)
+    results = list(first.get("data", []))
 
-        res = api_get("stats", params)
+    cursor = first.get("meta", {}).get("next_cursor") if results else None
+    while cursor:
+        res = api_get(endpoint, {**params, "cursor": cursor})
         batch = res.get("data", [])
         if not batch:
             break
-
         results.extend(batch)
         cursor = res.get("meta", {}).get("next_cursor")
-        if not cursor:
-            break
     return results
 
-# ---------------------------------------------------------
-# DEFENSIVE RATING
-# ---------------------------------------------------------
 
-def get_def_rating(team_abbr, season):
+# Persisted to disk so restarts start warm; disk entries ignore ttl, which is
+# fine for a table that changes about once a decade (Refresh data clears it)
+@st.cache_data(persist="disk", show_spinner=False)
+def _teams_map():
     teams = api_get("teams").get("data", [])
-    team_id = next((t["id"] for t in teams if t["abbreviation"] == team_abbr), None)
-    if not team_id:
-        return 0.0
+    if not teams:
+        # Raise so an outage is not memoized as an empty map for the whole TTL
+        raise LookupError("/teams returned no data")
+    return {t["abbreviation"]: t["id"] for t in teams}
 
-    games = []
-    cursor = None
 
-    while True:
-        params = {"seasons[]": season, "season_type": "regular", "per_page": 100}
-        if cursor:
-            params["cursor"] = cursor
+def get_teams_map():
+    """Returns {abbreviation: team_id} for every NBA team, or {} if /teams is unavailable."""
+    try:
+        return _teams_map()
+    except (LookupError, ApiError):
+        return {}
 
-        res = api_get("games", params)
-        batch = res.get("data", [])
-        if not batch:
-            break
 
-        for gm in batch:
-            if gm.get("status") != "Final": 
-                continue
-            if any(
-                gm.get(k) is None 
-                for k in ["home_team_id", "visitor_team_id", "home_team_score", "visitor_team_score"]
-            ):
-                continue
-            if gm["home_team_id"] == team_id or gm["visitor_team_id"] == team_id:
-                games.append(gm)
+@st.cache_data(ttl=600, max_entries=256, show_spinner=False)
+def _search_players(query):
+    raw = api_get("players", {"search": query, "per_page": 50})
+    players = raw.get("data", [])
+    keys = [(p["first_name"].strip(), p["last_name"].strip()) for p in players]
+    # Built in reverse so each name maps to the index of its first occurrence
+    first = {k: i for i, k in reversed(list(enumerate(keys)))}
+    return [p for i, (p, k) in enumerate(zip(players, keys)) if first[k] == i]
+
+
+def get_players(query):
+    # Normalised before the cache so "LeBron " and "lebron" share one entry
+    query = query.strip().lower()
+    if len(query) < 2:
+        return []
+    return _search_players(query)
+
+
+def get_stats_bulk(player_ids, season):
+    """
+    Season box scores for several players in one paginated request,
+    returned as {player_id: [stat rows]}. Players with no games map to [].
+    """
+    player_ids = sorted(set(player_ids))
+    rows = api_get_all("stats", {"player_ids[]": player_ids, "seasons[]": season, "per_page": 100})
+    by_player = {pid: [] for pid in player_ids}
+    for row in rows:
+        by_player.setdefault(row["player"]["id"], []).append(row)
+    return by_player
+
+
+# Not fresher than the 5-minute page cache in _cached_get, which a refresh
+# would only re-read; logs older than 10 minutes are refetched inline
+@stale_while_revalidate(fresh_for=5 * 60, stale_for=10 * 60)
+def get_stats(player_id, season):
+    return get_stats_bulk([player_id], season)[player_id]
+
+# ---------------------------------------------------------
+# DEFENSIVE RATING
+# ---------------------------------------------------------
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_team_games(team_id, season):
+    """
+    Completed regular-season games involving team_id, one row per game.
+    All filtering but status happens server side, e.g. for BOS in 2025:
+    /games?seasons[]=2025&team_ids[]=2&postseason=false&per_page=100
+    """
+    params = {
+        "seasons[]": season,
+        "team_ids[]": team_id,
+        "postseason": "false",
+        "per_page": 100,
+    }
+    games = [gm for gm in api_get_all("games", params) if gm.get("status") == "Final"]
+    # /games nests the teams (home_team: {id, ...}), so flatten to home_team_id
+    df = pd.json_normalize(games, sep="_").reindex(columns=[
+        "date", "home_team_id", "visitor_team_id", "home_team_score", "visitor_team_score",
+    ]).dropna()
+    df["date"] = pd.to_datetime(df["date"].astype("string").str.slice(0, 10), format="%Y-%m-%d")
+    return df
 
-        cursor = res.get("meta", {}).get("next_cursor")
-        if not cursor:
-            break
 
-    if not games:
+@stale_while_revalidate(fresh_for=15 * 60, stale_for=24 * 3600)
+def get_def_rating(team_abbr, season, as_of=None):
+    """
+    Average points allowed by team_abbr in games played on or before as_of
+    (default today); 0.0 for an unknown abbreviation. Raises ApiError when
+    the team list is unavailable, so an outage is never cached as a rating.
+    """
+    teams = get_teams_map()
+    if not teams:
+        raise ApiError("team list unavailable")
+    team_id = teams.get(team_abbr)
+    if not team_id:
         return 0.0
 
-    allowed = []
-    for gm in games:
-        if gm["home_team_id"] == team_id:
-            allowed.append(gm["visitor_team_score"])
-        else:
-            allowed.append(gm["home_team_score"])
+    # The season's games are cached once per team; moving as_of only re-masks them
+    games = get_team_games(team_id, season)
+    played = games[games["date"] <= pd.Timestamp(as_of or date.today())]
+    if played.empty:
+        return 0.0
 
-    return sum(allowed) / len(allowed)
+    allowed = np.where(
+        played["home_team_id"] == team_id,
+        played["visitor_team_score"],
+        played["home_team_score"],
+    )
+    return float(allowed.mean())
 
 # ---------------------------------------------------------
 # DATA PROCESSING
 # ---------------------------------------------------------
 
-def convert_minutes(v):
-    if not v:
-        return 0
-    if isinstance(v, (int, float)):
-        return float(v)
-    if ":" in str(v):
-        m, s = v.split(":")
-        return float(m) + float(s)/60
-    try:
-        return float(v)
-    except:
-        return 0
+# "MM:SS", "MM", or a plain number such as 34.5
+MINUTES_RE = r"^\s*(\d+(?:\.\d+)?)(?::(\d+))?\s*$"
+
+def convert_minutes(col):
+    """Parses a column of "MM:SS" / numeric minutes into float minutes."""
+    parts = col.astype("string").str.extract(MINUTES_RE).astype(float)
+    return (parts[0] + parts[1].fillna(0) / 60).fillna(0)
 
 def stats_to_df(stats):
-    rows = []
-    for s in stats:
-        g = s["game"]; t = s["team"]
-
-        rows.append({
-            "date": pd.to_datetime(g["date"][:10]),
-            "team_id": t["id"],
-            "home_id": g.get("home_team_id"),
-            "away_id": g.get("visitor_team_id"),
-            "pts": s.get("pts"),
-            "reb": s.get("reb"),
-            "ast": s.get("ast"),
-            "fg3m": s.get("fg3m"),
-            "stl": s.get("stl"),
-            "blk": s.get("blk"),
-            "turnover": s.get("turnover"),
-            "min": convert_minutes(s.get("min")),
-        })
-    return pd.DataFrame(rows)
+    """
+    Flattens /stats rows into one row per game:
+    date (datetime64), team_id/home_id/away_id (int16, 0 if missing),
+    the STAT_COLUMNS box-score counts (float32, NaN if missing), min (float32).
+    """
+    # Flatten the nested game/team objects in one call, e.g. game.date -> game_date
+    raw = pd.json_normalize(stats, sep="_").reindex(columns=[
+        "game_date", "team_id", "game_home_team_id", "game_visitor_team_id",
+        *STAT_FIELDS,
+    ])
+
+    def ids(col):
+        return pd.to_numeric(raw[col], errors="coerce").fillna(0).astype(np.int16)
+
+    return pd.DataFrame({
+        "date": pd.to_datetime(
+            raw["game_date"].astype("string").str.slice(0, 10),
+            format="%Y-%m-%d", errors="coerce", cache=True,
+        ),
+        "team_id": ids("team_id"),
+        "home_id": ids("game_home_team_id"),
+        "away_id": ids("game_visitor_team_id"),
+        **{c: pd.to_numeric(raw[c], errors="coerce").astype(np.float32) for c in STAT_COLUMNS},
+        "min": convert_minutes(raw["min"]).astype(np.float32),
+    })
 
 # ---------------------------------------------------------
 # METRICS
 # ---------------------------------------------------------
 
-def hit_rate(series, line):
-    s = series.dropna()
-    if len(s) == 0:
-        return 0, 0, 0
-    hits = (s >= line).sum()
-    return hits/len(s), hits, len(s)
+class GameLog(NamedTuple):
+    values: np.ndarray
+    team_ids: np.ndarray
+    home_ids: np.ndarray
+    away_ids: np.ndarray
+
+def game_log(df, field):
+    """
+    One stat plus the team id columns as numpy arrays, oldest game first.
+    The API does not guarantee date order, so every column is reindexed by
+    a single argsort before "last 10" and the split masks are taken.
+    """
+    order = np.argsort(df["date"].to_numpy(), kind="stable")
+    return GameLog(*(df[c].to_numpy()[order] for c in (field, "team_id", "home_id", "away_id")))
+
+def split_metrics(values, masks, line):
+    """
+    Hit counts, sample sizes and averages for several row subsets at once.
+    values: 1-D stat array, masks: (k, n) boolean array with one row per split.
+    NaN values are ignored; an empty split averages to 0.
+    """
+    valid = ~np.isnan(values)
+    m = masks & valid
+    totals = m.sum(axis=1)
+    hits = (m & (values >= line)).sum(axis=1)
+    sums = m.astype(values.dtype) @ np.where(valid, values, 0)
+    avgs = np.divide(sums, totals, out=np.zeros(len(totals)), where=totals > 0)
+    return hits, totals, avgs
+
+# Glow colour by hit rate: <=50% red, <=60% orange, <=70% yellow, else green
+COLOR_STOPS = (0.50, 0.60, 0.70)
+COLORS = ("#e74c3c", "#e67e22", "#f1c40f", "#2ecc71")
 
 def glow_color(p):
-    if p <= 0.50: return "#e74c3c"
-    if p <= 0.60: return "#e67e22"
-    if p <= 0.70: return "#f1c40f"
-    return "#2ecc71"
+    # bisect_left keeps each stop in the lower bucket, matching "p <= stop"
+    return COLORS[bisect.bisect_left(COLOR_STOPS, p)]
+
+# Card styling shared by every metric card; injected once per page in main()
+CARD_CSS = """
+<style>
+.mc-grid{display:grid;grid-template-columns:repeat(3,1fr);}
+.mc{background:#111;border-radius:10px;padding:14px;margin:6px;color:white;border:2px solid;}
+.mc-label{font-size:13px;color:#ccc;}
+.mc-value{font-size:22px;font-weight:700;}
+.mc-avg{font-size:14px;color:#aaa;}
+</style>
+"""
+
+CARD_TMPL = string.Template(
+    '<div class="mc" style="border-color:$color;box-shadow:0 0 12px $color;">'
+    '<div class="mc-label">$label</div>'
+    '<div class="mc-value">$hits_txt ($pct_txt)</div>'
+    '<div class="mc-avg">Avg: $avg</div>'
+    '</div>'
+)
 
 def card(label, hits, total, avg):
+    """Returns the HTML for one metric card."""
     pct = hits / total if total > 0 else 0
     pct_txt = f"{pct*100:.0f}%"
     hits_txt = f"{hits}/{total}"
     color = glow_color(pct)
 
-    st.markdown(
-        f"""
-        <div style="
-            background:#111;
-            border-radius:10px;
-            padding:14px;
-            margin:6px;
-            border:2px solid {color};
-            box-shadow:0 0 12px {color};
-            color:white;">
-            <div style="font-size:13px;color:#ccc;">{label}</div>
-            <div style="font-size:22px;font-weight:700;">{hits_txt} ({pct_txt})</div>
-            <div style="font-size:14px;color:#aaa;">Avg: {avg:.1f}</div>
-        </div>
-        """,
-        unsafe_allow_html=True
+    return CARD_TMPL.substitute(
+        color=color, label=label, hits_txt=hits_txt, pct_txt=pct_txt, avg=f"{avg:.1f}"
     )
 
 # ---------------------------------------------------------
 # PROJECTION MODEL
 # ---------------------------------------------------------
 
-def projected_value(last10, season_avg, home_avg, def_rating):
+def projected_value(last10, season_avg, home_avg, def_rating, league_avg=114.0):
+    """
+    Weighted projection adjusted for opponent defense.
+    Accepts scalars or equal-length arrays, so many props can be projected
+    in one call; a def_rating of 0 means "unknown" and applies no adjustment.
+    """
+    last10, season_avg, home_avg, def_rating = (
+        np.asarray(x, dtype=np.float64) for x in (last10, season_avg, home_avg, def_rating)
+    )
     base = 0.5*last10 + 0.3*season_avg + 0.2*home_avg
-    league_avg = 114
-    adj = 1 + ((league_avg - def_rating) / league_avg) * 0.4 if def_rating else 1
+    adj = np.where(def_rating > 0, 1 + ((league_avg - def_rating) / league_avg) * 0.4, 1.0)
     return base * adj
 
 # ---------------------------------------------------------
-# SAVE SYSTEM (CSV)
+# SAVE SYSTEM (PARQUET)
 # ---------------------------------------------------------
 
+def _fragment_name():
+    return f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}.parquet"
+
+def _write_fragment(table):
+    SAVED_PROPS.mkdir(exist_ok=True)
+    name = _fragment_name()
+    # Dot-prefixed temp files are ignored by the Parquet reader until renamed
+    tmp = SAVED_PROPS / f".{name}.tmp"
+    pq.write_table(table, tmp, compression="zstd")
+    tmp.replace(SAVED_PROPS / name)
+
+@st.cache_resource
+def _saved_lock():
+    # Every session runs in this one process, so a shared lock serialises
+    # the steps that read fragments and then remove or rename files
+    return threading.Lock()
+
+def _migrate_legacy_csv():
+    if not LEGACY_SAVED_CSV.exists():
+        return
+    with _saved_lock():
+        # Re-checked under the lock: another session may have just imported it
+        if LEGACY_SAVED_CSV.exists():
+            legacy = pd.read_csv(LEGACY_SAVED_CSV, dtype={"odds": str})
+            _write_fragment(pa.Table.from_pandas(legacy, schema=SAVED_SCHEMA, preserve_index=False))
+            LEGACY_SAVED_CSV.rename(LEGACY_SAVED_CSV.with_name("saved_props.csv.bak"))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_saved(path, mtime_ns):
+    # mtime_ns is only part of the cache key: adding a fragment bumps the
+    # directory mtime, which invalidates the cached table
+    return pd.read_parquet(path)
+
 def load_saved():
-    if SAVED_PROPS.exists():
-        return pd.read_csv(SAVED_PROPS)
+    _migrate_legacy_csv()
+    # Under the lock, so a read never lists parts that compaction is removing
+    with _saved_lock():
+        if SAVED_PROPS.is_dir():
+            _finish_compaction()
+            if any(SAVED_PROPS.glob("*.parquet")):
+                return _read_saved(str(SAVED_PROPS), SAVED_PROPS.stat().st_mtime_ns)
     return pd.DataFrame()
 
+@st.cache_data(max_entries=2, show_spinner=False)
+def _saved_csv(path, mtime_ns):
+    # Keyed like _read_saved, so the export is rebuilt only after a save
+    df = _read_saved(path, mtime_ns).sort_values("timestamp", ascending=False)
+    return df.to_csv(index=False).encode()
+
+def saved_csv():
+    """Full saved-props history as CSV bytes, newest first."""
+    with _saved_lock():
+        return _saved_csv(str(SAVED_PROPS), SAVED_PROPS.stat().st_mtime_ns)
+
+def _finish_compaction():
+    """
+    Completes (or discards) a compaction cut short by a crash, so its rows
+    are never shown twice or lost. Call with _saved_lock() held.
+    """
+    if COMPACT_MANIFEST.exists():
+        # The merged file is complete: drop whichever parts are left, then publish it
+        for name in json.loads(COMPACT_MANIFEST.read_text()):
+            (SAVED_PROPS / name).unlink(missing_ok=True)
+        if COMPACT_PENDING.exists():
+            COMPACT_PENDING.replace(SAVED_PROPS / _fragment_name())
+        COMPACT_MANIFEST.unlink()
+    else:
+        # No manifest means every part is still in place; the merge is redone later
+        COMPACT_PENDING.unlink(missing_ok=True)
+
+def _compact_saved():
+    """Merges the per-save fragments into one file once too many pile up."""
+    with _saved_lock():
+        _finish_compaction()
+        parts = sorted(SAVED_PROPS.glob("*.parquet"))
+        if len(parts) <= SAVED_COMPACT_AT:
+            return
+        # The merge is written under a name the reader ignores, and the
+        # manifest of merged parts marks it complete. _finish_compaction then
+        # removes the parts before renaming the merge into place, so readers
+        # never see both. A save landing meanwhile keeps its own fragment.
+        merged = pa.concat_tables(pq.read_table(p, schema=SAVED_SCHEMA) for p in parts)
+        pq.write_table(merged, COMPACT_PENDING, compression="zstd")
+        tmp = SAVED_PROPS / ".compact.json.tmp"
+        tmp.write_text(json.dumps([p.name for p in parts]))
+        tmp.replace(COMPACT_MANIFEST)
+        _finish_compaction()
+
 def save_prop(row):
-    df = load_saved()
-    df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-    df.to_csv(SAVED_PROPS, index=False)
+    # One new file per save; existing history is never re-read or rewritten
+    _write_fragment(pa.Table.from_pylist([row], schema=SAVED_SCHEMA))
+    _compact_saved()
 
 # ---------------------------------------------------------
 # ANALYSIS ENGINE
 # ---------------------------------------------------------
 
 def analyze(player, stat, line, odds, opp_abbr):
-    season = get_current_nba_season()
+    # One "today" for the whole run, so the season and the defensive-rating
+    # cutoff cannot disagree when an analysis straddles midnight
+    today = date.today()
+    season = get_current_nba_season(today)
+
+    # The player's game log and the opponent's defensive rating are
+    # independent requests, so fetch them concurrently. The rating only
+    # adjusts the projection, so it is not allowed to hold up the page.
+    ex = ThreadPoolExecutor(max_workers=2)
+    f_stats = ex.submit(get_stats, player["id"], season)
+    f_def = ex.submit(get_def_rating, opp_abbr, season, today)
+    ex.shutdown(wait=False)
+    try:
+        stats = f_stats.result()
+    except ApiError as e:
+        # Stop here rather than report zeros built from missing data, and drop
+        # the previous analysis so Save can't store it under this run
+        st.session_state.last_analysis = None
+        st.error(f"Couldn't load game logs from balldontlie ({e}). It may be rate limiting; try again shortly.")
+        return
 
-    stats = get_stats(player["id"], season)
     df = stats_to_df(stats)
 
     field = STAT_MAP[stat]
 
-    # --- Calculate splits ---
-    last10 = df.tail(10)[field]
-    last10_avg = last10.mean()
-    _, h10, t10 = hit_rate(last10, line)
-
-    season_avg = df[field].mean()
-    _, hs, ts2 = hit_rate(df[field], line)
-
-    home = df[df["team_id"] == df["home_id"]][field]
-    away = df[df["team_id"] != df["home_id"]][field]
-
-    home_avg = home.mean()
-    _, hh, th = hit_rate(home, line)
-
-    away_avg = away.mean()
-    _, ha, ta = hit_rate(away, line)
-
     # --- H2H ---
-    teams = api_get("teams").get("data", [])
-    opp_id = next((t["id"] for t in teams if t["abbreviation"] == opp_abbr), None)
+    teams = get_teams_map()
+    if not teams:
+        st.warning("Couldn't load the team list from balldontlie, so the Vs Opponent split is empty for this run.")
+    opp_id = teams.get(opp_abbr)
 
+    # --- Calculate splits (one pass over the stat column) ---
+    log = game_log(df, field)
+    n = len(log.values)
+
+    is_home = log.team_ids == log.home_ids
     if opp_id:
-        vs = df[(df["home_id"] == opp_id) | (df["away_id"] == opp_id)][field]
-        vs_avg = vs.mean() if not vs.empty else 0
-        _, hv, tv = hit_rate(vs, line) if not vs.empty else (0, 0, 0)
+        vs_opp = (log.home_ids == opp_id) | (log.away_ids == opp_id)
     else:
-        vs_avg = hv = tv = 0
-
-    # --- Defensive Rating ---
-    def_rating = get_def_rating(opp_abbr, season)
+        vs_opp = np.zeros(n, dtype=bool)
+
+    masks = np.stack([
+        np.arange(n) >= n - 10,   # last 10
+        np.ones(n, dtype=bool),   # season
+        is_home,
+        ~is_home,
+        vs_opp,
+    ])
+    hits, totals, avgs = split_metrics(log.values, masks, line)
+    h10, hs, hh, ha, hv = hits.tolist()
+    t10, ts2, th, ta, tv = totals.tolist()
+    last10_avg, season_avg, home_avg, away_avg, vs_avg = avgs.tolist()
 
     # --- Projection ---
-    proj = projected_value(last10_avg, season_avg, home_avg, def_rating)
+    # A rating still loading or failed counts as unknown (no adjustment); a
+    # slow fetch keeps going in the background and lands in the cache for the next run
+    def_note = None
+    try:
+        def_rating = f_def.result(timeout=DEF_RATING_WAIT)
+    except FutureTimeout:
+        def_rating = 0.0
+        def_note = "Def rating pending… projection shown without the opponent adjustment. Run again to include it."
+    except ApiError:
+        def_rating = 0.0
+        def_note = "Def rating unavailable; projection shown without the opponent adjustment."
+    proj = float(projected_value(last10_avg, season_avg, home_avg, def_rating))
 
     # --- Display UI ---
     st.markdown("### Performance Metrics")
     
-    c1, c2, c3 = st.columns(3)
-    with c1: card("Last 10 ≥ Line", h10, t10, last10_avg)
-    with c2: card("Season ≥ Line", hs, ts2, season_avg)
-    with c3: card("Home ≥ Line", hh, th, home_avg)
-
-    c4, c5, c6 = st.columns(3)
-    with c4: card("Away ≥ Line", ha, ta, away_avg)
-    with c5: card("Vs Opponent ≥ Line", hv, tv, vs_avg)
-    with c6: card("Opponent Defensive Rating", 0, 0, def_rating)
+    # All six cards go out as a single markdown element
+    cards = [
+        card("Last 10 ≥ Line", h10, t10, last10_avg),
+        card("Season ≥ Line", hs, ts2, season_avg),
+        card("Home ≥ Line", hh, th, home_avg),
+        card("Away ≥ Line", ha, ta, away_avg),
+        card("Vs Opponent ≥ Line", hv, tv, vs_avg),
+        card("Opponent Defensive Rating", 0, 0, def_rating),
+    ]
+    st.markdown(f'<div class="mc-grid">{"".join(cards)}</div>', unsafe_allow_html=True)
 
     st.subheader("Projection")
     st.metric(f"Projected {stat}", f"{proj:.1f}")
+    if def_note:
+        st.caption(def_note)
 
     # Store all results in session_state for saving
     st.session_state.last_analysis = {
@@ -336,30 +681,63 @@ def analyze(player, stat, line, odds, opp_abbr):
 # UI
 # ---------------------------------------------------------
 
+@st.fragment
+def saved_props_panel():
+    # A fragment, so clicking download reruns only this panel and leaves the
+    # analysis above on screen
+    df = load_saved()
+    if df.empty:
+        st.info("No saved props yet.")
+        return
+
+    df = df.sort_values("timestamp", ascending=False)
+    if len(df) > SAVED_TABLE_ROWS:
+        st.caption(f"Showing the {SAVED_TABLE_ROWS} most recent of {len(df)} saved props.")
+    st.dataframe(df.head(SAVED_TABLE_ROWS),
+                 hide_index=True,
+                 use_container_width=True)
+    st.download_button("Download full history",
+                       saved_csv(),
+                       "saved_props.csv",
+                       mime="text/csv")
+
+
 def main():
     st.set_page_config(page_title="Top Prop Picks", layout="wide")
     st.title("Top Prop Picks – NBA Prop Evaluator")
+    st.markdown(CARD_CSS, unsafe_allow_html=True)
+
+    if not API_KEY:
+        st.error("No balldontlie API key found. Set BDL_API_KEY in .streamlit/secrets.toml or the environment.")
+        st.stop()
+
+    if st.sidebar.button("Refresh data", help="Drop cached API responses and refetch"):
+        st.cache_data.clear()
+        _swr_state.clear()
 
     # --- Player Search ---
-    query = st.text_input("Search Player:")
+    query = st.text_input("Search Player:", key="player_query")
     player = None
 
     if query:
-        players = get_players(query)
+        try:
+            players = get_players(query)
+        except ApiError:
+            st.error("Player search is unavailable right now. Try again shortly.")
+            players = []
         if players:
-            labels = [
-                f"{p['first_name']} {p['last_name']} ({p['team']['abbreviation']})"
+            by_label = {
+                f"{p['first_name']} {p['last_name']} ({p['team']['abbreviation']})": p
                 for p in players
-            ]
-            sel = st.selectbox("Select Player:", labels)
-            player = players[labels.index(sel)]
+            }
+            sel = st.selectbox("Select Player:", tuple(by_label), key="player_sel")
+            player = by_label[sel]
 
-    stat = st.selectbox("Stat Type:", list(STAT_MAP.keys()))
+    stat = st.selectbox("Stat Type:", STAT_OPTIONS, key="stat_sel")
     line = st.number_input("Betting Line:", min_value=0.0, step=0.5)
     odds = st.text_input("Odds:")
 
-    opp_select = st.selectbox("Opponent:", [f"{n} ({a})" for n, a in NBA_TEAMS])
-    opp_abbr = opp_select.split("(")[-1].replace(")", "")
+    opp_abbr = LABEL_TO_ABBR[st.selectbox("Opponent:", OPP_LABELS, key="opp_sel")]
 
     if player and st.button("Run Analysis", type="primary"):
         analyze(player, stat, line, odds, opp_abbr)
@@ -376,14 +754,7 @@ def main():
     # --- Table of Saved Props ---
     st.markdown("---")
     st.subheader("Saved Props")
-
-    df = load_saved()
-    if df.empty:
-        st.info("No saved props yet.")
-    else:
-        st.dataframe(df.sort_values("timestamp", ascending=False),
-                     hide_index=True,
-                     use_container_width=True)
+    saved_props_panel()
 
 if __name__ == "__main__":
     main()